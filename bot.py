@@ -2,23 +2,48 @@ import os
 import random
 import asyncio
 import aiohttp
+from aiohttp import web
+import aiofiles
+import aiofiles.os as aio_os
 import logging
+import mimetypes
+import orjson
 import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 from dotenv import load_dotenv
 from pyrogram import Client, filters
+from pyrogram.errors import FloodWait, MessageNotModified, RPCError
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from flask import Flask
-from threading import Thread
 
 # ============ CONFIG ============
 load_dotenv()
 
-API_ID = int(os.getenv("API_ID"))
-API_HASH = os.getenv("API_HASH")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
 
-if not API_ID or not API_HASH or not BOT_TOKEN:
-    raise ValueError("API_ID, API_HASH, and BOT_TOKEN must be set.")
+def _require(name):
+    value = os.environ.get(name)
+    if not value:
+        raise SystemExit(f"Missing env {name}. API_ID, API_HASH, and BOT_TOKEN must be set.")
+    return value
+
+
+def _require_positive_int(name, default=None):
+    value = os.environ.get(name) or default
+    if value is None:
+        value = _require(name)
+    try:
+        number = int(value)
+    except ValueError:
+        raise SystemExit(f"{name} must be an integer, got {value!r}.") from None
+    if number <= 0:
+        raise SystemExit(f"{name} must be a positive integer, got {number}.")
+    return number
+
+
+API_ID = _require_positive_int("API_ID")
+API_HASH = _require("API_HASH")
+BOT_TOKEN = _require("BOT_TOKEN")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,31 +56,86 @@ bot = Client(
     in_memory=True
 )
 
+# GoFile server lookup cache, refreshed at most every _SERVER_TTL seconds
+_SERVER_TTL = 300
+_server_cache = {"name": None, "exp": 0.0}
+_server_lock = asyncio.Lock()
+
+# Cap concurrent transfers so parallel users don't thrash disk and uplink.
+# Each transfer streams through exactly one GoFile POST, so this also caps POSTs
+_UPLOAD_SEM = asyncio.Semaphore(_require_positive_int("MAX_CONCURRENT_UPLOADS", "3"))
+
+# Shared HTTP session so uploads reuse pooled connections and cached DNS
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                ttl_dns_cache=600,
+                use_dns_cache=True,
+                keepalive_timeout=75
+            )
+        )
+    return _session
+
 # ============ HELPERS ============
+_BAR_FULL = "●" * 10
+_BAR_EMPTY = "○" * 10
+
+_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+
+
+def _format_size(size, decimal_places):
+    if size <= 0:
+        return f"{0:.{decimal_places}f} B"
+    # Each unit is 2**10 of the previous one, so the bit length picks the unit
+    i = min(max((int(size).bit_length() - 1) // 10, 0), 5)
+    return f"{size / (1 << (i * 10)):.{decimal_places}f} {_UNITS[i]}"
+
+
+@lru_cache(maxsize=256)
+def _format_byte_count(size: int, decimal_places: int) -> str:
+    return _format_size(size, decimal_places)
+
+
 def human_readable_size(size, decimal_places=2):
-    for unit in ["B", "KB", "MB", "GB", "TB"]:
-        if size < 1024:
-            return f"{size:.{decimal_places}f} {unit}"
-        size /= 1024
-    return f"{size:.{decimal_places}f} PB"
+    # Byte counts repeat across status edits; speeds are floats and rarely do
+    if isinstance(size, int):
+        return _format_byte_count(size, decimal_places)
+    return _format_size(size, decimal_places)
 
 
-async def progress(current, total, message, status_message, start_time, file_name):
+async def progress(current, total, static_hdr, status_message, start_time):
     now = time.time()
-    diff = now - start_time or 1
     percentage = current * 100 / total
+    pct_int = int(percentage)
+
+    if now < status_message._flood_until:
+        return
+
+    # Edit at most every 2s or every 5%, but always show the final tick
+    if (
+        now - status_message._last_edit < 2
+        and pct_int - status_message._last_pct < 5
+        and current != total
+    ):
+        return
+
+    diff = now - start_time or 1
     speed = current / diff
     eta = (total - current) / speed if speed > 0 else 0
 
-    progress_str = "⫷{}{}⫸".format(
-        "●" * int(percentage // 10),
-        "○" * (10 - int(percentage // 10))
-    )
+    n = int(percentage // 10)
+    if n > 10:
+        n = 10
+    progress_str = f"⫷{_BAR_FULL[:n]}{_BAR_EMPTY[:10 - n]}⫸"
 
     text = (
-        f"**📂 File:** `{file_name}`\n"
-        f"**📦 Size:** `{human_readable_size(total)}`\n\n"
-        f"**⬇️ Downloading...**\n"
+        f"{static_hdr}"
         f"{progress_str} `{percentage:.2f}%`\n"
         f"**⚡ Speed:** `{human_readable_size(speed)}/s`\n"
         f"**⏱️ ETA:** `{int(eta)}s`"
@@ -63,96 +143,413 @@ async def progress(current, total, message, status_message, start_time, file_nam
 
     try:
         await status_message.edit(text)
-    except:
+        status_message._last_edit = now
+        status_message._last_pct = pct_int
+    except MessageNotModified:
+        pass
+    except FloodWait as e:
+        # Sleeping here would stall the download feeding this callback, so
+        # skip edits until Telegram's wait has passed instead
+        status_message._flood_until = now + e.value
+    except RPCError as e:
+        # A failed progress edit (e.g. the status was deleted) must not abort
+        # the transfer that is awaiting this callback
+        logger.warning(f"Progress edit failed: {e!r}")
+
+
+async def safe_edit(status_message, text, **kwargs):
+    # Status edits are display-only, so a failed one must not cancel a transfer
+    try:
+        await status_message.edit(text, **kwargs)
+    except MessageNotModified:
         pass
+    except RPCError as e:
+        logger.warning(f"Status edit failed: {e!r}")
 
 
 # ============ SERVER FETCH ============
 async def get_best_server():
-    try:
-        async with aiohttp.ClientSession() as session:
+    if _server_cache["name"] and time.time() < _server_cache["exp"]:
+        return _server_cache["name"]
+
+    async with _server_lock:
+        # Another handler may have refreshed the cache while we waited
+        if _server_cache["name"] and time.time() < _server_cache["exp"]:
+            return _server_cache["name"]
+
+        try:
+            session = await _get_session()
             async with session.get("https://api.gofile.io/servers", timeout=10) as resp:
-                data = await resp.json()
+                data = orjson.loads(await resp.read())
                 servers = data["data"]["servers"]
                 best = min(servers, key=lambda s: s.get("load", 9999))["name"]
                 logger.info(f"✅ Selected server: {best}")
+                _server_cache["name"] = best
+                _server_cache["exp"] = time.time() + _SERVER_TTL
                 return best
+        except Exception as e:
+            logger.error(f"Server fetch error: {e}")
+            return "store1"
+
+
+def invalidate_server():
+    # Force the next upload attempt to pick a fresh server
+    _server_cache["exp"] = 0.0
+
+
+# ============ PIPELINE ============
+DOWNLOAD_DIR = "downloads"
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class Spool:
+    """A file being streamed from Telegram to disk while it is uploaded."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.finished = asyncio.Event()
+        self.read_lock = asyncio.Lock()
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        self._changed.set()
+
+    async def wait(self):
+        await self._changed.wait()
+        self._changed.clear()
+
+
+async def spool_download(message, spool, static_hdr, status_message, start_time):
+    try:
+        async with aiofiles.open(spool.path, "wb") as f:
+            async for chunk in bot.stream_media(message):
+                await f.write(chunk)
+                await f.flush()
+                spool.written += len(chunk)
+                spool.notify()
+                await progress(spool.written, spool.size, static_hdr, status_message, start_time)
+        if spool.written != spool.size:
+            raise Exception(f"Downloaded {spool.written} of {spool.size} bytes")
     except Exception as e:
-        logger.error(f"Server fetch error: {e}")
-        return "store1"
+        spool.error = e
+        raise
+    finally:
+        spool.done = True
+        spool.finished.set()
+        spool.notify()
+
+
+async def announce_upload(spool, status_message, text):
+    # Once the download ends the progress bar stops; say the upload is still
+    # running so a slower uplink doesn't look like a frozen transfer
+    await spool.finished.wait()
+    if not spool.error:
+        await safe_edit(status_message, text)
+
+
+async def read_spool_chunks(spool, f):
+    # Follow the spool as it grows, so upload starts with the first chunk
+    offset = 0
+    while True:
+        if offset >= spool.written:
+            if spool.error:
+                raise spool.error
+            if spool.done:
+                break
+            await spool.wait()
+            continue
+
+        # Retries share one handle and an abandoned attempt may still be
+        # reading, so position and read together under the lock
+        async with spool.read_lock:
+            await f.seek(offset)
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, spool.written - offset))
+        offset += len(chunk)
+        yield chunk
+
+
+class SpoolPayload(aiohttp.payload.Payload):
+    """Upload body that follows a spool but declares its final size up front."""
+
+    def __init__(self, spool, f, **kwargs):
+        super().__init__(spool, content_type="application/octet-stream", **kwargs)
+        self._size = spool.size
+        self._file = f
+
+    async def write(self, writer):
+        async for chunk in read_spool_chunks(self._value, self._file):
+            await writer.write(chunk)
+
+    def decode(self, encoding="utf-8", errors="strict"):
+        raise TypeError("A spool payload cannot be decoded to text")
 
 
 # ============ UPLOAD ============
-async def upload_to_gofile(file_path):
-    filename = os.path.basename(file_path)
-    server = await get_best_server()
-    upload_url = f"https://{server}.gofile.io/uploadFile"
+MAX_RETRY_DELAY = 30
+UPLOAD_TIMEOUT = 900
 
-    timeout = aiohttp.ClientTimeout(total=900)
-    retries = 3
 
-    for attempt in range(1, retries + 1):
-        try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                with open(file_path, "rb") as f:
-                    form = aiohttp.FormData()
-                    form.add_field("file", f, filename=filename)
-
-                    logger.info(f"Uploading {filename} (attempt {attempt})")
-                    async with session.post(upload_url, data=form) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            return data["data"]["downloadPage"]
-                        else:
-                            logger.warning(await resp.text())
-        except Exception as e:
-            logger.error(f"Upload attempt {attempt} failed: {e}")
+async def arm_upload_deadline(spool, deadline):
+    # The body moves at Telegram's pace until the download ends, so the
+    # upload only gets its UPLOAD_TIMEOUT budget from that point on
+    await spool.finished.wait()
+    deadline.reschedule(asyncio.get_running_loop().time() + UPLOAD_TIMEOUT)
 
-        await asyncio.sleep(random.uniform(2, 5))
+
+async def upload_to_gofile(spool, filename):
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30)
+    retries = 3
+    session = await _get_session()
+
+    # The spool is created by the download task; wait for it to appear
+    while not spool.written and not spool.done:
+        await spool.wait()
+    if spool.error:
+        raise spool.error
+
+    # Open once per upload instead of reopening on every retry
+    async with aiofiles.open(spool.path, "rb") as f:
+        for attempt in range(1, retries + 1):
+            retry_after = 0
+            server = await get_best_server()
+            upload_url = f"https://{server}.gofile.io/uploadFile"
+            try:
+                writer = aiohttp.MultipartWriter("form-data")
+                # A sized payload keeps Content-Length on the request, as
+                # FormData did for a plain file, instead of chunked encoding
+                part = writer.append_payload(SpoolPayload(spool, f))
+                part.set_content_disposition("form-data", name="file", filename=filename)
+
+                logger.info(f"Uploading {filename} (attempt {attempt})")
+                async with asyncio.timeout(None) as deadline:
+                    armer = asyncio.create_task(arm_upload_deadline(spool, deadline))
+                    try:
+                        async with session.post(upload_url, data=writer, timeout=timeout) as resp:
+                            if resp.status == 200:
+                                data = orjson.loads(await resp.read())
+                                return data["data"]["downloadPage"]
+                            else:
+                                header = resp.headers.get("Retry-After", "")
+                                if resp.status in (429, 503) and header.isdigit():
+                                    retry_after = min(int(header), MAX_RETRY_DELAY)
+                                if resp.status >= 500:
+                                    invalidate_server()
+                                logger.warning(await resp.text())
+                    finally:
+                        armer.cancel()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                logger.error(f"Upload attempt {attempt} to {server} failed: {e!r}")
+                # A failed Telegram download also breaks the body write; that
+                # says nothing about the GoFile server, so keep it cached
+                if spool.error:
+                    raise
+                invalidate_server()
+            except Exception as e:
+                logger.error(f"Upload attempt {attempt} failed: {e}")
+                if spool.error:
+                    raise
+
+            if attempt < retries:
+                # Exponential backoff with jitter, honouring the server's Retry-After
+                delay = min(MAX_RETRY_DELAY, 1.5 * (2 ** (attempt - 1))) + random.uniform(0, 1.0)
+                await asyncio.sleep(max(delay, retry_after))
 
     raise Exception("Upload failed after retries")
 
 
 # ============ FILE HANDLER ============
+BATCH_WINDOW = 1.5
+BATCH_MAX_FILES = 10
+
+# Files a chat sends back-to-back are collected into one batch
+_chat_queues = {}
+_chat_drainers = {}
+_batch_tasks = set()
+
+
+def get_media(message):
+    return message.document or message.video or message.audio
+
+
+# Extensions pyrogram falls back to when the mime type gives none
+_DEFAULT_EXTENSIONS = {"document": ".zip", "video": ".mp4", "audio": ".mp3"}
+
+
+def get_file_name(message):
+    file = get_media(message)
+    if file.file_name:
+        return file.file_name
+
+    # Unnamed media (often mobile videos and audio) get a name the way
+    # pyrogram's download() builds one, so the GoFile copy keeps its extension
+    kind = "document" if message.document else "video" if message.video else "audio"
+    extension = mimetypes.guess_extension(file.mime_type or "") or _DEFAULT_EXTENSIONS[kind]
+    date = message.date or datetime.now()
+    return f"{kind}_{date:%Y-%m-%d_%H-%M-%S}_{message.id}{extension}"
+
+
 @bot.on_message(filters.document | filters.video | filters.audio)
 async def handle_file(_, message):
-    file = message.document or message.video or message.audio
-    file_name = file.file_name
-    file_size = file.file_size
+    file = get_media(message)
 
-    if file_size > 4 * 1024 * 1024 * 1024:
+    if file.file_size > 4 * 1024 * 1024 * 1024:
         await message.reply("❌ File too large. Max 4GB.")
         return
 
-    status = await message.reply(
-        f"📂 `{file_name}`\n📦 `{human_readable_size(file_size)}`\n\n⬇️ Downloading..."
-    )
+    chat_id = message.chat.id
+    queue = _chat_queues.setdefault(chat_id, asyncio.Queue())
+    queue.put_nowait(message)
+    if chat_id not in _chat_drainers:
+        _chat_drainers[chat_id] = asyncio.create_task(drain_chat(chat_id))
 
-    start_time = time.time()
-    file_path = await message.download(
-        progress=progress,
-        progress_args=(message, status, start_time, file_name)
-    )
 
+async def drain_chat(chat_id):
+    queue = _chat_queues[chat_id]
+    # Status replies for one chat go out one at a time instead of in a burst
+    reply_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
     try:
-        await status.edit("📤 Uploading to GoFile...")
-        link = await upload_to_gofile(file_path)
-
-        await status.edit(
-            f"✅ **Upload Complete**\n\n"
-            f"📂 `{file_name}`\n"
-            f"📦 `{human_readable_size(file_size)}`\n\n"
-            f"🔗 [Download Link]({link})",
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("📥 Download", url=link)]
-            ])
+        while not queue.empty():
+            # Every file starts as soon as it arrives; the window, measured
+            # from the batch's first file, only decides which links share a summary
+            batch = [queue.get_nowait()]
+            tasks = [asyncio.create_task(transfer_file(batch[0], reply_lock))]
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < BATCH_MAX_FILES:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(message)
+                tasks.append(asyncio.create_task(transfer_file(message, reply_lock)))
+
+            task = asyncio.create_task(process_batch(batch, tasks))
+            _batch_tasks.add(task)
+            task.add_done_callback(_batch_tasks.discard)
+    finally:
+        del _chat_drainers[chat_id]
+        del _chat_queues[chat_id]
+
+
+async def process_batch(batch, tasks):
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    links = []
+    failed = []
+    unreported = False
+    for message, result in zip(batch, results):
+        if isinstance(result, BaseException):
+            # The file's own status message may never have been sent or updated
+            file_name = get_file_name(message)
+            logger.error(f"Transfer of {file_name} failed", exc_info=result)
+            failed.append(file_name)
+            unreported = True
+        elif result[1] is None:
+            failed.append(result[0])
+        else:
+            links.append(result)
+
+    if len(batch) < 2 and not unreported:
+        return
+
+    lines = [f"📂 `{name}`\n🔗 [Download Link]({link})" for name, link in links]
+    lines += [f"❌ `{name}`" for name in failed]
+    icon = "⚠️" if failed else "✅"
+    text = "\n\n".join(lines)
+    try:
+        await batch[-1].reply(
+            f"{icon} **{len(links)}/{len(batch)} Files Uploaded**\n\n{text}",
+            disable_web_page_preview=True
         )
     except Exception as e:
-        await status.edit(f"❌ Upload failed:\n`{e}`")
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        logger.error(f"Batch summary failed: {e!r}")
+
+
+async def transfer_file(message, reply_lock):
+    file = get_media(message)
+    file_name = get_file_name(message)
+    file_size = file.file_size
+
+    size_hr = human_readable_size(file_size)
+    queued_text = f"📂 `{file_name}`\n📦 `{size_hr}`\n\n⏳ Queued..."
+    downloading_text = f"📂 `{file_name}`\n📦 `{size_hr}`\n\n⬇️ Downloading..."
+
+    async with reply_lock:
+        queued = _UPLOAD_SEM.locked()
+        status = await message.reply(queued_text if queued else downloading_text)
+
+    status._last_edit = 0.0
+    status._last_pct = -10
+    status._flood_until = 0.0
+
+    # File name and size never change during a transfer, so render them once
+    static_hdr = (
+        f"**📂 File:** `{file_name}`\n"
+        f"**📦 Size:** `{size_hr}`\n\n"
+        f"**🔄 Transferring to GoFile...**\n"
+    )
+
+    # Show that the file is waiting for a transfer slot rather than stalled
+    if _UPLOAD_SEM.locked() and not queued:
+        await safe_edit(status, queued_text)
+        queued = True
+
+    async with _UPLOAD_SEM:
+        if queued:
+            await safe_edit(status, downloading_text)
+
+        start_time = time.time()
+        spool = Spool(
+            os.path.join(DOWNLOAD_DIR, f"{message.chat.id}_{message.id}"),
+            file_size
+        )
+        download = asyncio.create_task(
+            spool_download(message, spool, static_hdr, status, start_time)
+        )
+        uploading = asyncio.create_task(
+            announce_upload(
+                spool, status,
+                f"📂 `{file_name}`\n📦 `{size_hr}`\n\n📤 Uploading to GoFile..."
+            )
+        )
+
+        try:
+            # The body only ends once the download has finished cleanly
+            link = await upload_to_gofile(spool, file_name)
+        except Exception as e:
+            logger.error(f"Transfer of {file_name} failed: {e!r}")
+            uploading.cancel()
+            await safe_edit(status, f"❌ Upload failed:\n`{e}`")
+            return file_name, None
+        finally:
+            download.cancel()
+            uploading.cancel()
+            await asyncio.gather(download, uploading, return_exceptions=True)
+            try:
+                await aio_os.remove(spool.path)
+            except FileNotFoundError:
+                pass
+
+    # The file is on GoFile now; a failed edit here must not lose the link
+    await safe_edit(
+        status,
+        f"✅ **Upload Complete**\n\n"
+        f"📂 `{file_name}`\n"
+        f"📦 `{size_hr}`\n\n"
+        f"🔗 [Download Link]({link})",
+        disable_web_page_preview=True,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📥 Download", url=link)]
+        ])
+    )
+    return file_name, link
 
 
 # ============ START ============
@@ -164,23 +561,36 @@ async def start(_, message):
     )
 
 
-# ============ FLASK KEEP-ALIVE ============
-def start_flask():
-    app = Flask(__name__)
+# ============ KEEP-ALIVE ============
+async def home(request):
+    return web.Response(text="Bot is alive!")
 
-    @app.route("/")
-    def home():
-        return "Bot is alive!"
 
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+async def start_web():
+    app = web.Application()
+    app.router.add_get("/", home)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", int(os.environ.get("PORT", 5000)))
+    await site.start()
+    return runner
 
 
 # ============ MAIN ============
 async def main():
-    Thread(target=start_flask, daemon=True).start()
+    runner = await start_web()
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     await bot.start()
+    await _get_session()
     logger.info("🚀 GoFile Uploader Bot started successfully!")
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if _session and not _session.closed:
+            await _session.close()
+        await bot.stop()
+        await runner.cleanup()
 
 
 if __name__ == "__main__":